@@ -7,7 +7,11 @@ requested.
 '''
 
 from flask import render_template, Flask, request
+from concurrent.futures import ThreadPoolExecutor, wait
+import os
 import sqlite3
+import threading
+import time
 import matplotlib
 
 matplotlib.use('Agg')   # see 'Matplotlib in a web application server' for understanding this issue
@@ -16,6 +20,74 @@ import matplotlib.pyplot as plt
 # Set the application as a Flask object
 app = Flask(__name__)
 
+# The shard registry: each store (warehouse) has its own database file, with store name as key and file as value.
+# Add an entry for each store to be managed
+SHARDS = {'main': 'data.db'}
+# The store used when the request does not state one
+DEFAULT_STORE = 'main'
+# Maximum time in seconds the administrator page waits for the answer of the shards
+SHARD_TIMEOUT = 10
+# Number of threads used to query the shards. As a store is not queried again while a previous query on it is still
+# running (see fanOut), twice the number of stores leaves free threads even with a query stuck on every store
+SHARD_WORKERS = 2 * len(SHARDS)
+# The pool of threads querying the shards, shared by all the requests. Stores shall be registered in SHARDS above
+shardPool = ThreadPoolExecutor(max_workers=SHARD_WORKERS)
+# The last query sent to each store, with (store, task, arguments) as key and the query as value. Requests arriving
+# while a query is running share it instead of sending a new one
+runningQueries = {}
+# The keys of the running queries which have not finished in time
+stuckQueries = set()
+# The lock protecting runningQueries and stuckQueries, as requests are served in parallel threads
+shardLock = threading.Lock()
+
+def connectStore(store=DEFAULT_STORE):
+    '''
+    connectStore opens a connection to the database of the given store. The database is opened in read-write mode, so
+    a wrong database file in SHARDS raises an error instead of creating a new empty database.
+    :param store: the store name, as registered in SHARDS
+    :return: the connection to the store database
+    '''
+    return sqlite3.connect('file:' + SHARDS[store] + '?mode=rw', uri=True)
+
+def getStore():
+    '''
+    getStore gets the store stated in the current request (form data or URL arguments). If it is not stated, the
+    default store is used. The store returned could not be registered in SHARDS: it shall be checked before using it
+    (see validStore).
+    :return: the store name
+    '''
+    return request.values.get('store', DEFAULT_STORE)
+
+def validStore(store):
+    '''
+    validStore checks if the store stated in a request is registered in SHARDS and its database file exists.
+    :param store: the store name stated in the request
+    :return: True if the store can be used, False otherwise
+    '''
+    return store in SHARDS and os.path.isfile(SHARDS[store])
+
+def storeError(store):
+    '''
+    storeError sends to the browser the index page with an error message, when the store stated in the request cannot
+    be used (see validStore). It avoids reading or writing data of a store different from the one requested.
+    :param store: the store name stated in the request
+    :return: the index page with the error message
+    '''
+    if store in SHARDS:
+        error = "The database of the store " + store + " is not available"
+    else:
+        error = "The store " + store + " doesn't exist"
+    return render_template('index.html', error=error)
+
+@app.context_processor
+def storeContext():
+    '''
+    storeContext makes available to all templates the current store and the list of registered stores, so forms can
+    keep the store they are working on.
+    :return: a dictionary with the template variables
+    '''
+    return dict(store=getStore(), stores=list(SHARDS.keys()))
+
 @app.route('/', methods=['POST', 'GET'])
 def index():
     '''
@@ -42,13 +114,16 @@ def identify():
     if userId.strip() == "":
         error = "Please, introduce a user identification"
         return render_template('index.html', error=error)
-    userRegister, userList = getUserData(userId)
+    store = getStore()
+    if not validStore(store):
+        return storeError(store)
+    userRegister, userList = getUserData(userId, store)
     if userRegister['admin'] == 'checked':
         return makeAdminPage()
     elif userRegister['supplier'] == 'checked':
-        return makeSupplierPage(userRegister)
+        return makeSupplierPage(userRegister, store)
     elif userRegister['customer'] == 'checked':
-        return makeCustomerPage(userRegister)
+        return makeCustomerPage(userRegister, store)
     error = "This user identification doesn't exist"
     return render_template('index.html', error=error)
 
@@ -61,7 +136,10 @@ def updateusers():
     of the one to be processed.
     :return: the updateuser page rendered with the user list
     '''
-    userRegister, userList = getUserData()
+    store = getStore()
+    if not validStore(store):
+        return storeError(store)
+    userRegister, userList = getUserData(store=store)
     return render_template('updateusers.html',
                            users=userList,
                            selected_user=userRegister,
@@ -78,7 +156,10 @@ def displayuser():
         userId = request.form['userId']
     else:
         userId = request.args.get('userId')
-    userRegister, userList = getUserData(userId)
+    store = getStore()
+    if not validStore(store):
+        return storeError(store)
+    userRegister, userList = getUserData(userId, store)
     return render_template('updateusers.html',
                            users=userList,
                            selected_user=userRegister,
@@ -98,14 +179,17 @@ def saveuser():
     unaffordable delete.
     :return: a html page rendered according the result from the above tasks
     '''
-    # sets an empty register and gets the user list from the database
-    userRegister, userList = getUserData()
+    # gets the store the user belongs to, sets an empty register and gets the user list from the store database
+    store = getStore()
+    if not validStore(store):
+        return storeError(store)
+    userRegister, userList = getUserData(store=store)
     #fills the user register dictionary with all the values from the page
     for k in request.form.keys():
         userRegister[k] = request.form[k]
     error = ""
     try:
-        dbConexion = sqlite3.connect('data.db')
+        dbConexion = connectStore(store)
         cursor = dbConexion.cursor()
         if "update" in request.form.keys():
             # sets the SQL query to update the current register
@@ -161,7 +245,7 @@ def saveuser():
     except sqlite3.Error as sqlerror:
         error = sqlerror
     dbConexion.close()
-    userRegister, userList = getUserData()
+    userRegister, userList = getUserData(store=store)
     return render_template('updateusers.html',
                            users=userList,
                            selected_user=userRegister,
@@ -176,7 +260,10 @@ def updateproducts():
     selection of the one to be processed.
     :return: the updateproducts page rendered with the user list
     '''
-    productRegister, productList = getProductData()
+    store = getStore()
+    if not validStore(store):
+        return storeError(store)
+    productRegister, productList = getProductData(store=store)
     return render_template('updateproducts.html',
                            products=productList,
                            selected_product=productRegister,
@@ -193,7 +280,10 @@ def displayproduct():
         productId = request.form['productId']
     else:
         productId = request.args.get('productId')
-    productRegister, productList = getProductData(productId)
+    store = getStore()
+    if not validStore(store):
+        return storeError(store)
+    productRegister, productList = getProductData(productId, store)
     return render_template('updateproducts.html',
                            products=productList,
                            selected_product=productRegister,
@@ -213,14 +303,17 @@ def saveproduct():
     unaffordable delete.
     :return: a html page rendered according the result from the above tasks
     '''
-    # sets an empty register and gets the product list from the database
-    productRegister, productList = getProductData()
+    # gets the store the product belongs to, sets an empty register and gets the product list from the store database
+    store = getStore()
+    if not validStore(store):
+        return storeError(store)
+    productRegister, productList = getProductData(store=store)
     #fills the product register dictionary with all the values from the page
     for k in request.form.keys():
         productRegister[k] = request.form[k]
     error = ""
     try:
-        dbConexion = sqlite3.connect('data.db')
+        dbConexion = connectStore(store)
         cursor = dbConexion.cursor()
         if "update" in request.form.keys():
             # sets the SQL query to update the current register
@@ -276,7 +369,7 @@ def saveproduct():
     except sqlite3.Error as sqlerror:
         error=sqlerror
     dbConexion.close()
-    productRegister,productList = getProductData()
+    productRegister,productList = getProductData(store=store)
     return render_template('updateproducts.html',
                            products=productList,
                            selected_product=productRegister,
@@ -293,9 +386,12 @@ def updateactivity():
     3) the user identifiers
     :return: the updateactivity page rendered with the activity list
     '''
-    userRegister, userList = getUserData()
-    productRegister, productList = getProductData()
-    activityRegister, activityList = getactivityData()
+    store = getStore()
+    if not validStore(store):
+        return storeError(store)
+    userRegister, userList = getUserData(store=store)
+    productRegister, productList = getProductData(store=store)
+    activityRegister, activityList = getactivityData(store=store)
     return render_template('updateactivity.html',
                            activity=activityList,
                            selected_activity=activityRegister,
@@ -315,9 +411,12 @@ def displayactivity():
     else:
         activityId = request.args.get('activityId')
 
-    userRegister, userList = getUserData(activityId)
-    productRegister, productList = getProductData(activityId)
-    activityRegister, activityList = getactivityData(activityId)
+    store = getStore()
+    if not validStore(store):
+        return storeError(store)
+    userRegister, userList = getUserData(activityId, store)
+    productRegister, productList = getProductData(activityId, store)
+    activityRegister, activityList = getactivityData(activityId, store)
     return render_template('updateactivity.html',
                            activity=activityList,
                            selected_activity=activityRegister,
@@ -339,16 +438,19 @@ def saveactivity():
     unaffordable delete.
     :return: a html page rendered according the result from the above tasks
     '''
-    # sets an empty register and gets the lists from the database
-    userRegister, userList = getUserData()
-    productRegister, productList = getProductData()
-    activityRegister, activityList = getactivityData()
+    # gets the store the activity belongs to, sets an empty register and gets the lists from the store database
+    store = getStore()
+    if not validStore(store):
+        return storeError(store)
+    userRegister, userList = getUserData(store=store)
+    productRegister, productList = getProductData(store=store)
+    activityRegister, activityList = getactivityData(store=store)
     #fills the activity register dictionary with all the values from the page
     for k in request.form.keys():
         activityRegister[k] = request.form[k]
     error = ""
     try:
-        dbConexion = sqlite3.connect('data.db')
+        dbConexion = connectStore(store)
         cursor = dbConexion.cursor()
         if "update" in request.form.keys():
             # sets the SQL query to update the current register
@@ -392,7 +494,7 @@ def saveactivity():
     except sqlite3.Error as sqlerror:
         error = sqlerror
     # sets an empty register and gets activity list from the database
-    activityRegister, activityList = getactivityData()
+    activityRegister, activityList = getactivityData(store=store)
     return render_template('updateactivity.html',
                            activity=activityList,
                            selected_activity=activityRegister,
@@ -417,12 +519,13 @@ def hbarsPlot (pltData, pltTitle, pltXlabel, pltYlable, fileName):
     plt.barh(list(pltData.keys()), list(pltData.values()))
     plt.savefig('static/img/' + fileName)
 
-def getPeriod():
+def getPeriod(store=DEFAULT_STORE):
     '''
     Gets the initial and final date of the period activities in the BD
+    :param store: the store whose database is queried
     :return: initial and final date
     '''
-    dbConexion = sqlite3.connect('data.db')
+    dbConexion = connectStore(store)
     cursor = dbConexion.cursor()
     cursor.execute('SELECT MIN(date) FROM activity')
     initial = cursor.fetchone()
@@ -431,15 +534,16 @@ def getPeriod():
     dbConexion.close()
     return initial[0], final[0]
 
-def queryActivity(user, inout):
+def queryActivity(user, inout, store=DEFAULT_STORE):
     '''
     Performs the query on the DB extracting all products having activity (purchase or sale) in the period, and it cost
     or price.
     :param user: the user identification
     :param inout: the activity movements to be computed: "C" (inputs or purchase), "V" (outputs or sale)
+    :param store: the store whose database is queried
     :return: a list of registers, each one containing the product name and cost or price
     '''
-    dbConexion = sqlite3.connect('data.db')
+    dbConexion = connectStore(store)
     cursor = dbConexion.cursor()
     query = 'SELECT products.name, activity.price FROM products, activity WHERE activity.idproduct = products.id'
     if len(inout) != 0:
@@ -451,78 +555,198 @@ def queryActivity(user, inout):
     dbConexion.close()
     return allActs
 
-def makeAdminPage():
+def timedTask(task, store, *args):
     '''
-    makeAdminPage collect data related to all sales and purchases registered in the BD, and builds the web page
-    to show this data.
-    :return: the web page with administrator related data
+    timedTask runs a task on the database of a store, measuring the time it takes. Errors are caught and returned to
+    allow reporting them without stopping the tasks running on other stores.
+    :param task: the function to run; it receives the store as first parameter followed by the given arguments
+    :param store: the store whose database is queried
+    :return: the elapsed time in seconds, the result of the task (None if failed), and the error message (if any)
     '''
-    # put in a dictionary the sales per product during current period and plot them
-    dicData = getValues('V')
-    hbarsPlot(dicData, 'Sales per product', 'Sales', 'Product', 'graph-admin-sales.jpg')
-    # compute the total amount of sales
-    totalSales = 0
-    for product, price in dicData.items():
-        totalSales += price
-    # put in a dictionary the accumulated outputs for each product and generate the graph
-    dicData = getActivity('', 'V')
-    hbarsPlot(dicData, 'Units sold', 'Units', 'Product', 'graph-admin-units-sold.jpg')
-    # put in a dictionary the accumulated inputs for each product and compute balance
-    balance = getActivity('', 'C')
-    # compute the net balance of inventory
-    for product, cant in dicData.items():
+    start = time.perf_counter()
+    try:
+        result = task(store, *args)
+        error = ""
+    except Exception as taskError:
+        result = None
+        error = str(taskError)
+    return time.perf_counter() - start, result, error
+
+def fanOut(task, *args):
+    '''
+    fanOut runs in parallel the given task on every store registered in SHARDS, using the threads in shardPool. It waits
+    up to SHARD_TIMEOUT seconds: stores not answering in time, or having errors, are reported and excluded from the
+    results, so that a slow or failed store does not stall the whole page.
+    The threads of the stores not answering in time cannot be stopped and keep running in the background. To avoid
+    piling up threads on a slow store, only one query with the same task and arguments runs on each store: concurrent
+    requests share it, and once it has not finished in time the store is reported as busy until the query ends.
+    :param task: the function to run; it receives the store as first parameter followed by the given arguments
+    :param args: the arguments for the task; they shall be hashable
+    :return: a dictionary with the store as key and the task result as value for the stores answering successfully,
+    and the list of registers [store, elapsed seconds, status] reporting on each store
+    '''
+    futures = {}
+    with shardLock:
+        for store in SHARDS:
+            key = (store, task, args)
+            future = runningQueries.get(key)
+            if future is None or future.done():
+                future = shardPool.submit(timedTask, task, store, *args)
+                runningQueries[key] = future
+                stuckQueries.discard(key)
+            elif key in stuckQueries:
+                continue
+            futures[store] = future
+    done, notDone = wait(futures.values(), timeout=SHARD_TIMEOUT)
+    with shardLock:
+        for store, future in futures.items():
+            if future not in notDone:
+                continue
+            key = (store, task, args)
+            # queries still waiting for a thread are cancelled: only the running ones are kept as stuck
+            if future.cancel():
+                if runningQueries.get(key) is future:
+                    del runningQueries[key]
+            elif runningQueries.get(key) is future:
+                stuckQueries.add(key)
+    results = {}
+    shardReport = []
+    for store in SHARDS:
+        if store not in futures:
+            shardReport.append([store, "", "Busy: previous query still running"])
+            continue
+        future = futures[store]
+        # a query shared with other request could have been cancelled by it
+        if future in notDone or future.cancelled():
+            shardReport.append([store, SHARD_TIMEOUT, "Timeout"])
+            continue
+        elapsed, result, error = future.result()
+        if error != "":
+            shardReport.append([store, round(elapsed, 3), "Error: " + error])
+        else:
+            results[store] = result
+            shardReport.append([store, round(elapsed, 3), "OK"])
+    return results, shardReport
+
+def addValues(total, partial):
+    '''
+    addValues accumulates in a dictionary the values of other one having the same keys (product names).
+    :param total: the dictionary where values are accumulated
+    :param partial: the dictionary with the values to be added
+    :return: the dictionary with accumulated values
+    '''
+    for product, value in partial.items():
+        if product in total:
+            total[product] = total[product] + value
+        else:
+            total[product] = value
+    return total
+
+def shardSummary(store):
+    '''
+    shardSummary collects from the database of a store the data shown in the administrator page: sales and units sold
+    per product, net balance of inventory, period of activities and products under minimum stock.
+    :param store: the store whose database is queried
+    :return: a dictionary with the data collected
+    '''
+    summary = {}
+    summary['sales'] = getValues('V', store)
+    summary['sold'] = getActivity('', 'V', store)
+    # put in a dictionary the accumulated inputs for each product and compute the net balance of inventory
+    balance = getActivity('', 'C', store)
+    for product, cant in summary['sold'].items():
         if product in balance:
             balance[product] = balance[product] - cant
         else:
             balance[product] = -cant
-    # plot balance
+    summary['balance'] = dict(balance)
+    summary['initial'], summary['final'] = getPeriod(store)
+    # stock levels are computed for each store, as each one has its own stock
+    summary['alerts'] = stockAlert(balance, store)
+    return summary
+
+def makeAdminPage():
+    '''
+    makeAdminPage collect data related to all sales and purchases registered in the BD of every store, and builds the
+    web page to show this data. Data of each store are collected in parallel (see fanOut) and merged.
+    :return: the web page with administrator related data
+    '''
+    summaries, shardReport = fanOut(shardSummary)
+    sales = {}
+    sold = {}
+    balance = {}
+    initials = []
+    finals = []
+    alerts = []
+    for store, summary in summaries.items():
+        addValues(sales, summary['sales'])
+        addValues(sold, summary['sold'])
+        addValues(balance, summary['balance'])
+        if summary['initial'] is not None:
+            initials.append(summary['initial'])
+        if summary['final'] is not None:
+            finals.append(summary['final'])
+        for alert in summary['alerts']:
+            alerts.append(alert + [store])
+    # plot the sales per product during current period and compute the total amount of sales
+    hbarsPlot(sales, 'Sales per product', 'Sales', 'Product', 'graph-admin-sales.jpg')
+    totalSales = 0
+    for product, price in sales.items():
+        totalSales += price
+    # plot the accumulated outputs and the net balance of inventory for each product
+    hbarsPlot(sold, 'Units sold', 'Units', 'Product', 'graph-admin-units-sold.jpg')
     hbarsPlot(balance, 'Product balance', 'Outputs minus inputs', 'Product', 'graph-admin-inventory.jpg')
-    initialDate, finalDate = getPeriod()
+    initialDate = min(initials) if len(initials) != 0 else None
+    finalDate = max(finals) if len(finals) != 0 else None
     return render_template('admin.html',
                            initial=initialDate,
                            final=finalDate,
                            sales=totalSales,
-                           alerts=stockAlert(balance))
+                           alerts=alerts,
+                           shards=shardReport)
 
-def makeSupplierPage(regCoP):
+def makeSupplierPage(regCoP, store=DEFAULT_STORE):
     '''
     makeSupplierPage collects data on all supplies from the BD for a given supplier and builds a web page to show them.
     :param regCoP: a register with the supplier identification data
+    :param store: the store the supplier belongs to
     :return: the web page with supplier related data
     '''
     # the register to keep data of the client or supplier
     # put in a dictionary the supplies per product during period and plot them
-    supplies = getActivity(regCoP.get("id"), 'C')
+    supplies = getActivity(regCoP.get("id"), 'C', store)
     hbarsPlot(supplies, 'Supplies per product', 'Supply', 'Product', 'graph-supplier.jpg')
-    initialDate, finalDate = getPeriod()
+    initialDate, finalDate = getPeriod(store)
     return render_template('supplier.html',
                            supplier=regCoP,
                            initial=initialDate,
                            final=finalDate)
 
-def makeCustomerPage(regCoP):
+def makeCustomerPage(regCoP, store=DEFAULT_STORE):
     '''
     makeCustomerPage collects data on all sales from the BD to a given customer and builds a web page to show them.
     :param regCoP: a register with the customer identification data
+    :param store: the store the customer belongs to
     :return: the web page with customer related data
     '''
     # put in a dictionary the sales per product during period and plot them
-    sales = getActivity(regCoP.get("id"), 'V')
+    sales = getActivity(regCoP.get("id"), 'V', store)
     hbarsPlot(sales, 'Sales per product', 'Sales', 'Product', 'graph-customer.jpg')
-    initialDate, finalDate = getPeriod()
+    initialDate, finalDate = getPeriod(store)
     return render_template('customer.html',
                            customer=regCoP,
                            initial=initialDate,
                            final=finalDate)
 
-def stockAlert(balance):
+def stockAlert(balance, store=DEFAULT_STORE):
     '''
     stckAlert computes the current amount of existences for each product and determines if its level is below the
     minimum requested. In this case, an alert flag is raised for the product.
     :param balance: a dictionary with the net amount of inputs minus outputs for each product during the current period
+    :param store: the store whose database is queried
     :return: the list of products below the alert level
     '''
-    dbConexion = sqlite3.connect('data.db')
+    dbConexion = connectStore(store)
     cursor = dbConexion.cursor()
     query = 'SELECT name, initialstock, minimunstock, location FROM products'
     cursor.execute(query)
@@ -546,13 +770,14 @@ def stockAlert(balance):
                 productsBelowLevel.append([name, reg[3], min, stock])
     return productsBelowLevel
 
-def getUserData(identification=""):
+def getUserData(identification="", store=DEFAULT_STORE):
     '''
     getUserData checks if the given user identification is correct, and returns the type of user it is and its register.
     :param identification: the user identification
+    :param store: the store whose database is queried
     :return: the user register (a dictionary), and the list of user identifications
     '''
-    dbConexion = sqlite3.connect('data.db')
+    dbConexion = connectStore(store)
     cursor = dbConexion.cursor()
     # generate the user identification list extracting from the tuples got from the query the id (1st element)
     cursor.execute('SELECT id FROM users')
@@ -573,15 +798,16 @@ def getUserData(identification=""):
     dbConexion.close()
     return userDict, userList
 
-def getActivity(user, inout):
+def getActivity(user, inout, store=DEFAULT_STORE):
     '''
     getActivity computes the number of inputs or outputs for the existing products for a given user.
     :param user: the user identification
     :param inout: the activity movements to be computed: "C" (input/purchase), "V" (output/sale)
+    :param store: the store whose database is queried
     :return: a dictionary with product id as key and total amount of units as value
     '''
     # get the requested inputs and/or outputs for the given user (if any)
-    allActs = queryActivity(user, inout)
+    allActs = queryActivity(user, inout, store)
     # put in a dictionary product id as key and total amount of units as value
     actProduct = {}
     for reg in allActs:
@@ -593,14 +819,15 @@ def getActivity(user, inout):
             actProduct[product] = 1
     return actProduct
 
-def getValues(inout):
+def getValues(inout, store=DEFAULT_STORE):
     '''
     getValues computes the value of sales or purchases of each product for the period
     :param inout: the movements to be computed: "C" (inputs/purchases), "V" (outputs/sales)
+    :param store: the store whose database is queried
     :return: a dictionary with accumulated price values of each product for the period
     '''
     # get the requested inputs or outputs
-    allActs = queryActivity('', inout)
+    allActs = queryActivity('', inout, store)
     # a dictionary to accumulate amounts: key is the product id and value the accumulated amount
     actProduct = {}
     for reg in allActs:
@@ -612,15 +839,16 @@ def getValues(inout):
             actProduct[product] = reg[1]
     return actProduct
 
-def getProductData(identification=""):
+def getProductData(identification="", store=DEFAULT_STORE):
     '''
     getUserData checks if the given identification for a product is correct, and returns the product register and the
     list of existing products.
     :param identification: the product identification
+    :param store: the store whose database is queried
     :return: the product register as a dictionary and the list of products id
     '''
     # see getUserData comments. This function has the same logic
-    dbConexion = sqlite3.connect('data.db')
+    dbConexion = connectStore(store)
     cursor = dbConexion.cursor()
     cursor.execute('SELECT id FROM products')
     productList = [p[0] for p in cursor.fetchall()]
@@ -635,15 +863,16 @@ def getProductData(identification=""):
     dbConexion.close()
     return productDict, productList
 
-def getactivityData(identification=""):
+def getactivityData(identification="", store=DEFAULT_STORE):
     '''
     getUserData checks if the given activity identification is correct, and returns the activity register and the list
     of existing activities.
     :param identification: the activity identification
+    :param store: the store whose database is queried
     :return: the activity register as a dictionary and the list of activities in the DB
     '''
     # see getUserData comments. This function has the same logic
-    dbConexion = sqlite3.connect('data.db')
+    dbConexion = connectStore(store)
     cursor = dbConexion.cursor()
     cursor.execute('SELECT id,idproduct,date FROM activity')
     activityList = cursor.fetchall()
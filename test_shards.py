@@ -0,0 +1,177 @@
+''' test_shards.py
+Tests of the multi-store (shard) support in main.py: the parallel queries to the stores, the report on their state,
+and the merge of their data in the administrator page. Two temporary store databases are built copying data.db.
+They can be run with: python -m unittest test_shards
+'''
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import main
+
+
+# The number of times slowTask has been started on each store
+slowCalls = {}
+
+def slowTask(store, delay):
+    '''
+    slowTask is a task for fanOut which takes the given time to answer in the 'slow' store.
+    :param store: the store name
+    :param delay: the time in seconds to wait in the 'slow' store
+    :return: the store name
+    '''
+    slowCalls[store] = slowCalls.get(store, 0) + 1
+    if store == 'slow':
+        time.sleep(delay)
+    return store
+
+
+class ShardsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.dbA = os.path.join(self.tmpDir, 'a.db')
+        self.dbB = os.path.join(self.tmpDir, 'b.db')
+        shutil.copy('data.db', self.dbA)
+        shutil.copy('data.db', self.dbB)
+        # store b has one more sale, the latest of all the activities
+        dbConexion = sqlite3.connect(self.dbB)
+        dbConexion.execute('INSERT INTO activity (idproduct,inout,idsuppocust,price,date,serialnum,etc) '
+                           'SELECT id, "V", "", 1000, "9999-12-31", 0, 0 FROM products LIMIT 1')
+        dbConexion.commit()
+        dbConexion.close()
+        self.savedShards = main.SHARDS
+        self.savedTimeout = main.SHARD_TIMEOUT
+        self.savedPool = main.shardPool
+        self.setShards({'main': self.dbA, 'b': self.dbB})
+
+    def tearDown(self):
+        # wait for the queries left running by the timeout tests
+        for future in main.runningQueries.values():
+            if not future.cancelled():
+                future.result()
+        main.runningQueries.clear()
+        main.stuckQueries.clear()
+        slowCalls.clear()
+        main.shardPool.shutdown()
+        main.SHARDS = self.savedShards
+        main.SHARD_TIMEOUT = self.savedTimeout
+        main.shardPool = self.savedPool
+        shutil.rmtree(self.tmpDir)
+
+    def setShards(self, shards):
+        '''
+        setShards registers the given stores, with a pool of threads sized as main.py does for its registry.
+        :param shards: a dictionary with store name as key and database file as value
+        '''
+        main.SHARDS = shards
+        main.shardPool = ThreadPoolExecutor(max_workers=2 * len(shards))
+
+    def adminData(self):
+        '''
+        adminData gets the data sent to the admin.html template, without rendering it nor plotting graphs.
+        :return: a dictionary with the template variables
+        '''
+        with mock.patch('main.hbarsPlot'), \
+                mock.patch('main.render_template', side_effect=lambda name, **data: data):
+            return main.makeAdminPage()
+
+    def test_merge(self):
+        summaryA = main.shardSummary('main')
+        summaryB = main.shardSummary('b')
+        data = self.adminData()
+        self.assertEqual([r[2] for r in data['shards']], ['OK', 'OK'])
+        self.assertEqual(data['sales'], sum(summaryA['sales'].values()) + sum(summaryB['sales'].values()))
+        self.assertEqual(data['initial'], min(summaryA['initial'], summaryB['initial']))
+        self.assertEqual(data['final'], '9999-12-31')
+        expected = [a + ['main'] for a in summaryA['alerts']] + [a + ['b'] for a in summaryB['alerts']]
+        self.assertEqual(data['alerts'], expected)
+        # units and balance: compare the plotted dictionaries with the sum of each store
+        with mock.patch('main.hbarsPlot') as plot, mock.patch('main.render_template'):
+            main.makeAdminPage()
+        plotted = dict((c.args[4], c.args[0]) for c in plot.call_args_list)
+        for key, fileName in (('sold', 'graph-admin-units-sold.jpg'), ('balance', 'graph-admin-inventory.jpg')):
+            expected = main.addValues(dict(summaryA[key]), summaryB[key])
+            self.assertEqual(plotted[fileName], expected)
+
+    def test_failed_store(self):
+        missing = os.path.join(self.tmpDir, 'missing.db')
+        self.setShards(dict(main.SHARDS, missing=missing))
+        data = self.adminData()
+        self.assertEqual(data['shards'][2][0], 'missing')
+        self.assertTrue(data['shards'][2][2].startswith('Error:'))
+        self.assertFalse(os.path.exists(missing))
+        # data of the other stores is still shown
+        self.assertEqual(data['final'], '9999-12-31')
+
+    def test_timeout(self):
+        main.SHARD_TIMEOUT = 0.2
+        self.setShards(dict(main.SHARDS, slow=self.dbA))
+        results, shardReport = main.fanOut(slowTask, 1)
+        self.assertEqual(results, {'main': 'main', 'b': 'b'})
+        self.assertEqual(shardReport[2], ['slow', 0.2, 'Timeout'])
+        # the stuck store is not queried again until its previous query ends
+        results, shardReport = main.fanOut(slowTask, 1)
+        self.assertNotIn('slow', results)
+        self.assertTrue(shardReport[2][2].startswith('Busy'))
+        main.runningQueries[('slow', slowTask, (1,))].result()
+        results, shardReport = main.fanOut(slowTask, 1)
+        self.assertEqual(shardReport[2], ['slow', 0.2, 'Timeout'])
+        self.assertEqual(slowCalls['slow'], 2)
+
+    def test_concurrent_timeout(self):
+        main.SHARD_TIMEOUT = 0.5
+        self.setShards(dict(main.SHARDS, slow=self.dbA))
+        reports = []
+        def adminLoad():
+            reports.append(main.fanOut(slowTask, 2)[1])
+        loads = [threading.Thread(target=adminLoad) for i in range(8)]
+        for load in loads:
+            load.start()
+        for load in loads:
+            load.join()
+        # the concurrent loads share one query on the slow store
+        self.assertEqual(slowCalls['slow'], 1)
+        for shardReport in reports:
+            self.assertEqual(shardReport[0][2], 'OK')
+            self.assertEqual(shardReport[2][2], 'Timeout')
+        # the next load gets the healthy stores and does not wait for the slow one
+        start = time.perf_counter()
+        results, shardReport = main.fanOut(slowTask, 2)
+        self.assertLess(time.perf_counter() - start, main.SHARD_TIMEOUT)
+        self.assertEqual(set(results), {'main', 'b'})
+        self.assertTrue(shardReport[2][2].startswith('Busy'))
+        self.assertEqual(slowCalls['slow'], 1)
+
+    def test_unknown_store(self):
+        client = main.app.test_client()
+        form = {'store': 'typo', 'id': 'YY', 'name': 'YY', 'location': '', 'price': '1', 'minimunstock': '1',
+                'initialstock': '1', 'tax': '0', 'description': '', 'new': '2'}
+        response = client.post('/saveproduct', data=form)
+        self.assertIn(b'The store typo doesn&#39;t exist', response.data)
+        for dbFile in (self.dbA, self.dbB):
+            dbConexion = sqlite3.connect(dbFile)
+            count = dbConexion.execute('SELECT COUNT(*) FROM products WHERE id = "YY"').fetchone()[0]
+            dbConexion.close()
+            self.assertEqual(count, 0)
+
+    def test_missing_store_database(self):
+        missing = os.path.join(self.tmpDir, 'missing.db')
+        self.setShards(dict(main.SHARDS, missing=missing))
+        client = main.app.test_client()
+        for action in ('saveuser', 'saveproduct', 'saveactivity'):
+            response = client.post('/' + action, data={'store': 'missing', 'id': 'YY', 'new': '2'})
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b'The database of the store missing is not available', response.data)
+        self.assertFalse(os.path.exists(missing))
+
+
+if __name__ == '__main__':
+    unittest.main()